@@ -2,43 +2,163 @@
 import argparse
 import dataclasses
 import json
+import sys
 import time
+import warnings
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set
 
 import numpy as np
 import torch
 from tqdm import tqdm
 
-from vllm import LLM, SamplingParams
+from vllm import LLM, SamplingParams, envs
+from vllm.distributed import (cleanup_dist_env_and_memory, get_tp_group,
+                              model_parallel_is_initialized)
 from vllm.engine.arg_utils import EngineArgs
+from vllm.engine.metrics_types import (StatLoggerBase, Stats,
+                                       SupportsMetricsInfo)
 from vllm.inputs import PromptType
+from vllm.model_executor.layers.vocab_parallel_embedding import (
+    ParallelLMHead, VocabParallelEmbedding)
+from vllm.platforms import current_platform
 from vllm.utils import FlexibleArgumentParser
+from vllm.worker.cache_engine import CacheEngine
 
 
-def main(args: argparse.Namespace):
-    print(args)
+class SpecDecodeStatsCollector(StatLoggerBase):
+    """Keeps the latest cumulative spec decode metrics seen by the engine."""
 
-    engine_args = EngineArgs.from_cli_args(args)
+    def __init__(self) -> None:
+        super().__init__(local_interval=0.0)
+
+    def log(self, stats: Stats) -> None:
+        self.maybe_update_spec_decode_metrics(stats)
+
+    def info(self, type: str, obj: SupportsMetricsInfo) -> None:
+        pass
+
+
+def get_driver_model_runner(llm: LLM) -> Optional[Any]:
+    """Return the driver worker's runner that holds the target model."""
+    worker = getattr(llm.llm_engine.model_executor, "driver_worker", None)
+    # Spec decode wraps the target model's worker in a SpecDecodeWorker.
+    worker = getattr(worker, "scorer_worker", worker)
+    runner = getattr(worker, "model_runner", None)
+    # Multi-step runners delegate to the runner that actually holds the model.
+    runner = getattr(runner, "_base_model_runner", runner)
+    return runner if getattr(runner, "model", None) is not None else None
+
+
+def get_driver_model(llm: LLM) -> Optional[torch.nn.Module]:
+    """Return the target model loaded by the driver worker, if reachable."""
+    runner = get_driver_model_runner(llm)
+    return runner.model if runner is not None else None
 
+
+def estimate_decode_bytes_per_step(llm: LLM, model: torch.nn.Module,
+                                   args: argparse.Namespace) -> int:
+    """Estimate the bytes read from device memory by one decode step.
+
+    Every decode step reads all weights once plus the KV cache of every
+    sequence in the batch, taken here at its average context length. An
+    untied input embedding table is left out, since a step only gathers
+    one row per sequence from it.
+    """
+    engine = llm.llm_engine
+    lm_head = getattr(model, "lm_head", None)
+    lm_head_params: Set[int] = set()
+    for module in model.modules():
+        if module is lm_head or isinstance(module, ParallelLMHead):
+            lm_head_params.update(id(p) for p in module.parameters())
+    embedding_params = {
+        id(p)
+        for module in model.modules()
+        if isinstance(module, VocabParallelEmbedding)
+        for p in module.parameters()
+    } - lm_head_params
+    weight_bytes = sum(p.numel() * p.element_size()
+                       for p in model.parameters()
+                       if id(p) not in embedding_params)
+    kv_bytes_per_token = CacheEngine.get_cache_block_size(
+        engine.cache_config, engine.model_config,
+        engine.parallel_config) // engine.cache_config.block_size
+    avg_context_len = args.input_len + args.output_len / 2
+    return int(weight_bytes +
+               kv_bytes_per_token * args.batch_size * args.n * avg_context_len)
+
+
+def run_benchmark(args: argparse.Namespace, engine_args: EngineArgs,
+                  dummy_prompts: List[PromptType],
+                  sampling_params: SamplingParams) -> Optional[Dict[str, Any]]:
     # NOTE(woosuk): If the request cannot be processed in a single batch,
     # the engine will automatically process the request in multiple batches.
     llm = LLM(**dataclasses.asdict(engine_args))
 
-    sampling_params = SamplingParams(
-        n=args.n,
-        temperature=1.0,
-        top_p=1.0,
-        ignore_eos=True,
-        max_tokens=args.output_len,
-    )
-    print(sampling_params)
-    dummy_prompt_token_ids = np.random.randint(10000,
-                                               size=(args.batch_size,
-                                                     args.input_len))
-    dummy_prompts: List[PromptType] = [{
-        "prompt_token_ids": batch
-    } for batch in dummy_prompt_token_ids.tolist()]
+    # Custom all-reduce only matters with tensor parallelism.
+    all_reduce_info: Optional[Dict[str, Any]] = None
+    parallel_config = llm.llm_engine.parallel_config
+    if parallel_config.tensor_parallel_size > 1:
+        # The communicator can still disable itself at init even when the
+        # config allows it. With Ray SPMD workers the TP group only exists in
+        # the workers, so the backend cannot be inspected from here.
+        if parallel_config.disable_custom_all_reduce:
+            backend = "nccl"
+        elif model_parallel_is_initialized():
+            ca_comm = get_tp_group().ca_comm
+            backend = ("custom" if ca_comm is not None
+                       and not ca_comm.disabled else "nccl")
+        else:
+            backend = "unknown"
+        all_reduce_info = {
+            "disable_custom_all_reduce":
+            parallel_config.disable_custom_all_reduce,
+            "all_reduce_backend": backend,
+        }
+        print(f"All-reduce backend: {backend} (disable_custom_all_reduce="
+              f"{parallel_config.disable_custom_all_reduce})")
+        if args.disable_custom_all_reduce:
+            warnings.warn(
+                "Custom all-reduce is disabled, so tensor-parallel all-reduce "
+                "falls back to NCCL. Expect roughly 10% higher latency at "
+                "TP >= 2, plus extra NCCL buffer memory.",
+                stacklevel=2)
+        elif parallel_config.disable_custom_all_reduce:
+            print("Custom all-reduce was disabled by the parallel config "
+                  "for this setup (e.g. pipeline parallelism or MI250).")
+
+    spec_decode_stats = None
+    if engine_args.speculative_model and not engine_args.disable_log_stats:
+        spec_decode_stats = SpecDecodeStatsCollector()
+        llm.llm_engine.add_logger("spec_decode", spec_decode_stats)
+
+    if args.compile != "none":
+        print(
+            f"Compiling the model with torch.compile(mode={args.compile!r}). "
+            "Set TORCH_LOGS=cudagraphs to see why CUDA graphs are skipped.",
+            file=sys.stderr)
+        model_runner = get_driver_model_runner(llm)
+        if model_runner is None:
+            raise ValueError("--compile could not reach the driver worker's "
+                             "model with this executor.")
+        model_runner.model = torch.compile(model_runner.model,
+                                           mode=args.compile,
+                                           fullgraph=True)
+
+    track_memory = current_platform.is_cuda_alike()
+    peak_memory_bytes: List[int] = []
+
+    def _timed_run() -> float:
+        if track_memory:
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.perf_counter()
+        llm.generate(dummy_prompts,
+                     sampling_params=sampling_params,
+                     use_tqdm=False)
+        end_time = time.perf_counter()
+        if track_memory:
+            peak_memory_bytes.append(torch.cuda.max_memory_allocated())
+        return end_time - start_time
 
     def run_to_completion(profile_dir: Optional[str] = None):
         if profile_dir:
@@ -54,16 +174,16 @@ def main(args: argparse.Namespace):
                              use_tqdm=False)
             print(p.key_averages())
         else:
-            start_time = time.perf_counter()
-            llm.generate(dummy_prompts,
-                         sampling_params=sampling_params,
-                         use_tqdm=False)
-            end_time = time.perf_counter()
-            latency = end_time - start_time
-            return latency
+            return _timed_run()
 
     print("Warming up...")
-    for _ in tqdm(range(args.num_iters_warmup), desc="Warmup iterations"):
+    # Progress bars only help on an interactive terminal; in log files the
+    # carriage-return refreshes are noise.
+    disable_tqdm = not sys.stdout.isatty()
+
+    for _ in tqdm(range(args.num_iters_warmup),
+                  desc="Warmup iterations",
+                  disable=disable_tqdm or args.num_iters_warmup <= 5):
         run_to_completion(profile_dir=None)
 
     if args.profile:
@@ -74,26 +194,208 @@ def main(args: argparse.Namespace):
             ) / "vllm_benchmark_result" / f"latency_result_{time.time()}"
         print(f"Profiling (results will be saved to '{profile_dir}')...")
         run_to_completion(profile_dir=profile_dir)
-        return
+        return None
 
     # Benchmark.
-    latencies = []
-    for _ in tqdm(range(args.num_iters), desc="Profiling iterations"):
+    latencies: List[float] = []
+    peak_memory_bytes.clear()
+    for _ in tqdm(range(args.num_iters),
+                  desc="Profiling iterations",
+                  disable=disable_tqdm or args.num_iters <= 5):
         latencies.append(run_to_completion(profile_dir=None))
-    latencies = np.array(latencies)
+    latencies_arr = np.array(latencies)
     percentages = [10, 25, 50, 75, 90, 99]
-    percentiles = np.percentile(latencies, percentages)
-    print(f'Avg latency: {np.mean(latencies)} seconds')
+    avg_latency = float(latencies_arr.mean())
+    percentiles = np.percentile(latencies_arr, percentages).tolist()
+    print(f'Avg latency: {avg_latency} seconds')
     for percentage, percentile in zip(percentages, percentiles):
         print(f'{percentage}% percentile latency: {percentile} seconds')
 
+    results = {
+        "avg_latency": avg_latency,
+        "latencies": latencies,
+        "percentiles": dict(zip(percentages, percentiles)),
+    }
+    if all_reduce_info is not None:
+        results.update(all_reduce_info)
+
+    if track_memory:
+        print(f'Peak memory allocated: {max(peak_memory_bytes)} bytes')
+        results["peak_memory_bytes"] = peak_memory_bytes
+
+        model = get_driver_model(llm)
+        if engine_args.speculative_model:
+            # Each step may emit several tokens, so output_len is not the
+            # number of decode steps.
+            print("Skipping bandwidth estimate with speculative decoding.")
+        elif model is None:
+            print("Skipping bandwidth estimate: the driver worker's model is "
+                  "not reachable.")
+        elif args.output_len < 2:
+            print("Skipping bandwidth estimate: no decode steps to measure.")
+        else:
+            # The first output token comes from prefill, so decode runs
+            # output_len - 1 steps. Latency still includes prefill, which
+            # pulls the figure down. Peak memory includes the preallocated
+            # KV cache pool, so it is not used as the byte count.
+            decode_bytes_per_step = estimate_decode_bytes_per_step(
+                llm, model, args)
+            num_decode_steps = args.output_len - 1
+            achieved_bw_gbps = [
+                decode_bytes_per_step * num_decode_steps / latency / 1e9
+                for latency in latencies
+            ]
+            avg_achieved_bw_gbps = float(np.mean(achieved_bw_gbps))
+            print(f'Avg achieved bandwidth (estimate): '
+                  f'{avg_achieved_bw_gbps:.1f} GB/s')
+            results.update({
+                "decode_bytes_per_step": decode_bytes_per_step,
+                "achieved_bandwidth_gbps": achieved_bw_gbps,
+                "avg_achieved_bandwidth_gbps": avg_achieved_bw_gbps,
+            })
+
+    if spec_decode_stats is not None:
+        metrics = spec_decode_stats.spec_decode_metrics
+        if metrics is None or metrics.draft_tokens == 0:
+            print("No speculative decoding metrics were collected.")
+        else:
+            # The worker reports cumulative counters, which are only refreshed
+            # every few seconds, so the acceptance rate is aggregated over the
+            # whole run rather than per iteration.
+            alpha = metrics.accepted_tokens / metrics.draft_tokens
+            gamma = metrics.num_spec_tokens
+            expected_tokens_per_step = (gamma + 1 if alpha == 1.0 else
+                                        (1 - alpha**(gamma + 1)) / (1 - alpha))
+            print(f'Draft acceptance rate: {alpha:.3f}')
+            print('Expected tokens per step: '
+                  f'{expected_tokens_per_step:.3f} (k={gamma})')
+            print(f'System efficiency: {metrics.system_efficiency:.3f}')
+            results["spec_decode"] = {
+                "num_spec_tokens": gamma,
+                "draft_tokens": metrics.draft_tokens,
+                "accepted_tokens": metrics.accepted_tokens,
+                "emitted_tokens": metrics.emitted_tokens,
+                "draft_acceptance_rate": alpha,
+                "expected_tokens_per_step": expected_tokens_per_step,
+                "system_efficiency": metrics.system_efficiency,
+            }
+
+    return results
+
+
+def resolve_kv_cache_dtype(kv_cache_dtype: str) -> str:
+    # Match the engine, where a bare "fp8" KV cache means e4m3 on both CUDA
+    # and ROCm.
+    if kv_cache_dtype == "fp8":
+        return "fp8_e4m3"
+    return kv_cache_dtype
+
+
+def main(args: argparse.Namespace):
+    print(args)
+
+    # --compile requires --enforce-eager, so the warning would only be noise.
+    if args.enforce_eager and args.compile == "none":
+        warnings.warn(
+            "--enforce-eager disables CUDA graphs, so every decode step pays "
+            "the full kernel launch overhead. Expect roughly 20-50% higher "
+            "latency on small models and batch sizes.",
+            stacklevel=2)
+
+    if (args.dtype in ("float", "float32") and args.device in ("auto", "cuda")
+            and current_platform.is_cuda_alike()):
+        warnings.warn(
+            "FP32 halves tensor-core throughput and doubles activation/KV "
+            "bandwidth vs BF16; consider --dtype bfloat16.",
+            stacklevel=2)
+
+    engine_args = EngineArgs.from_cli_args(args)
+    if args.compile != "none":
+        # The decode CUDA graphs are captured from the uncompiled model while
+        # the LLM is constructed, so decode would never run the compiled
+        # module unless CUDA graphs are off.
+        if not engine_args.enforce_eager:
+            raise ValueError("--compile requires --enforce-eager.")
+        # Only a plain single-GPU model runner exposes the model to wrap.
+        if (engine_args.tensor_parallel_size > 1
+                or engine_args.pipeline_parallel_size > 1):
+            raise ValueError("--compile is only supported on a single GPU.")
+        if engine_args.speculative_model:
+            raise ValueError(
+                "--compile is not supported with speculative decoding.")
+        if engine_args.num_scheduler_steps > 1:
+            raise ValueError(
+                "--compile is not supported with multi-step scheduling.")
+        # Ray SPMD workers keep the model out of the driver process.
+        if (engine_args.distributed_executor_backend == "ray"
+                and envs.VLLM_USE_RAY_SPMD_WORKER):
+            raise ValueError(
+                "--compile is not supported with VLLM_USE_RAY_SPMD_WORKER=1.")
+
+    sampling_params = SamplingParams(
+        n=args.n,
+        temperature=1.0,
+        top_p=1.0,
+        ignore_eos=True,
+        max_tokens=args.output_len,
+    )
+    print(sampling_params)
+    rng = np.random.default_rng(0)
+    dummy_prompt_token_ids = rng.integers(10000,
+                                          size=(args.batch_size,
+                                                args.input_len),
+                                          dtype=np.int32)
+    # The engine expects List[int] token ids, so convert each contiguous
+    # int32 row exactly once instead of going through a nested list copy.
+    dummy_prompts: List[PromptType] = [{
+        "prompt_token_ids": row.tolist()
+    } for row in dummy_prompt_token_ids]
+
+    def benchmark(engine_args: EngineArgs) -> Optional[Dict[str, Any]]:
+        results = run_benchmark(args, engine_args, dummy_prompts,
+                                sampling_params)
+        if results is None or not engine_args.speculative_model:
+            return results
+
+        # Rerun without the speculator so the JSON output carries the
+        # non-speculative reference latency of the same configuration.
+        cleanup_dist_env_and_memory()
+        print("Benchmarking without speculative decoding...")
+        baseline = run_benchmark(
+            args,
+            dataclasses.replace(engine_args,
+                                speculative_model=None,
+                                num_speculative_tokens=None,
+                                speculative_disable_by_batch_size=None),
+            dummy_prompts, sampling_params)
+        assert baseline is not None
+        speedup = baseline["avg_latency"] / results["avg_latency"]
+        print(f'Speedup vs. non-speculative baseline: {speedup:.3f}x')
+        results["baseline_avg_latency"] = baseline["avg_latency"]
+        results["speedup"] = speedup
+        return results
+
+    if not args.kv_cache_dtype_sweep:
+        results = benchmark(engine_args)
+    else:
+        # The KV cache dtype cannot be switched on a live engine, so each
+        # entry of the sweep reloads the model with the same prompts.
+        # "fp8" resolves to a concrete variant, which may also be listed
+        # explicitly; benchmark each resolved dtype only once.
+        kv_cache_dtypes = list(
+            dict.fromkeys(
+                resolve_kv_cache_dtype(kv_cache_dtype)
+                for kv_cache_dtype in args.kv_cache_dtype_sweep))
+        results = {}
+        for kv_cache_dtype in kv_cache_dtypes:
+            print(f"Benchmarking kv_cache_dtype={kv_cache_dtype}...")
+            results[kv_cache_dtype] = benchmark(
+                dataclasses.replace(engine_args,
+                                    kv_cache_dtype=kv_cache_dtype))
+            cleanup_dist_env_and_memory()
+
     # Output JSON results if specified
-    if args.output_json:
-        results = {
-            "avg_latency": np.mean(latencies),
-            "latencies": latencies.tolist(),
-            "percentiles": dict(zip(percentages, percentiles.tolist())),
-        }
+    if args.output_json and not args.profile:
         with open(args.output_json, "w") as f:
             json.dump(results, f, indent=4)
 
@@ -128,6 +430,27 @@ if __name__ == '__main__':
         default=None,
         help=('path to save the pytorch profiler output. Can be visualized '
               'with ui.perfetto.dev or Tensorboard.'))
+    parser.add_argument(
+        '--kv-cache-dtype-sweep',
+        type=str,
+        nargs='+',
+        choices=['auto', 'fp8', 'fp8_e5m2', 'fp8_e4m3'],
+        default=None,
+        help='Benchmark each of the given KV cache dtypes in one invocation, '
+        'reloading the model for each. Overrides --kv-cache-dtype. As in the '
+        'engine, "fp8" means fp8_e4m3; list fp8_e5m2 explicitly to include '
+        'it. The JSON output holds one entry per dtype.')
+    parser.add_argument(
+        '--compile',
+        type=str,
+        choices=['none', 'default', 'reduce-overhead', 'max-autotune'],
+        default='none',
+        help='Wrap the model forward in torch.compile with the given mode. '
+        'Requires --enforce-eager, since vLLM\'s own decode CUDA graphs are '
+        'captured from the uncompiled model; compare against a plain '
+        '--enforce-eager run. Single GPU only, without speculative decoding '
+        'or multi-step scheduling. "reduce-overhead" and "max-autotune" '
+        'capture their own CUDA graphs and may OOM on small GPUs.')
     parser.add_argument(
         '--output-json',
         type=str,